@@ -1,11 +1,16 @@
 # https://api.openweathermap.org/data/3.0/onecall/day_summary?lat={lat}&lon={lon}&date={date}&units=metric&appid={API_key}
 
 from SECRETS import API_KEY, PROXY_ADDRESS
-from flatten_json import flatten
-import requests
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
+from functools import cache
+import geonamescache
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+import orjson
+import asyncio
 import pandas as pd
 import datetime
-from time import sleep
 import urllib.parse
 import os
 import csv
@@ -17,15 +22,21 @@ CITIES = ["Shenzhen", "Shanghai", "Guangzhou", "Beijing","Qingdao","Xi'an","Chen
 START_DATE = datetime.datetime(2021, 9,7)
 END_DATE = datetime.datetime(2021, 9,30)
 OUTPUT_FILE = ".\\data\\weather_data.csv"
+CACHE_DIR = ".\\.weather_cache"  # API responses are kept here so that re-runs skip the network
 
-RETRY_TIMES = 10
-RETRY_DELAY = 6
+RETRY_TIMES = 5
+RETRY_MAX_DELAY = 30  # seconds, the wait between attempts doubles up to this
+REQUEST_TIMEOUT = 10  # seconds
+MAX_CONNECTIONS = 4  # requests are multiplexed over these with HTTP/2
+RATE_LIMIT_CALLS = 60  # OpenWeather free tier allows 60 calls...
+RATE_LIMIT_PERIOD = 60  # ...per 60 seconds
+QUEUE_SIZE = 64  # max number of fetched rows waiting to be written
+FETCH_WORKERS = 10  # number of requests for weather data running at the same time
 
-def append_to_csv(file_path, data, fieldnames):
-    """Append a row to the CSV file"""
-    with open(file_path, "a", newline="", encoding="utf-8-sig") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writerow(data)
+# Historical data never changes, so successful responses are cached on disk indefinitely
+CACHE = Cache(CACHE_DIR)
+# Requests currently running, by cache key, so that concurrent identical requests share one API call
+_IN_FLIGHT = {}
 
 
 def confirm_overwrite(file_path):
@@ -42,79 +53,223 @@ def confirm_overwrite(file_path):
     return True
 
 
-def get_city_coordinates(city):
+async def get_city_coordinates(client, limiter, city):
     """Get latitude and longitude of a city. 
     
     ',China' will be added to the end of the city name for geo-coding purpose."""
+    key = f"geo|{city}"
+    if key in CACHE:
+        return CACHE[key]
+
+    # Look up the city in the offline database first, the API is only used as a fallback
+    if city in _offline_coordinates():
+        lat, lon = _offline_coordinates()[city]
+        print(f"{city}: {lat}, {lon} (offline)")
+        return lat, lon
+
     encoded_city = urllib.parse.quote(city, safe="") + ",China"
-    url = f"http://api.openweathermap.org/geo/1.0/direct?q={encoded_city}&limit=1&appid={API_KEY}"
-    response = requests.get(url)
-    data = response.json()
+    url = f"https://api.openweathermap.org/geo/1.0/direct?q={encoded_city}&limit=1&appid={API_KEY}"
+    try:
+        data = await make_request_with_retry(client, limiter, url)
+    except httpx.HTTPError as e:
+        print(f"*** Warning: geo-coding request for {city} failed: {_describe_error(e)} ***")
+        data = None
+
     if data:
         print(f"{city}: {data[0]["lat"]}, {data[0]["lon"]}")
+        CACHE[key] = data[0]["lat"], data[0]["lon"]
         return data[0]["lat"], data[0]["lon"]
     else:
         print(f"*** Error: no geo-code data found for {city} ***")
         return None, None
 
 
-def get_weather_data(city, lat, lon, date_str):
-    """Get weather data for a city on a specific date in the format YYYY-MM-DD"""
-    url = f"https://api.openweathermap.org/data/3.0/onecall/day_summary?lat={lat}&lon={lon}&date={date_str}&units=metric&appid={API_KEY}"
+@cache
+def _offline_coordinates():
+    """Coordinates of Chinese cities from the geonames database bundled with geonamescache.
+
+    If several cities share a name, the one with the largest population is kept."""
+    coordinates = {}
+    population = {}
+    for record in geonamescache.GeonamesCache().get_cities().values():
+        if record["countrycode"] != "CN":
+            continue
+        name = record["name"].replace("\u2019", "'")  # e.g. Xi’an
+        if record["population"] > population.get(name, -1):
+            coordinates[name] = record["latitude"], record["longitude"]
+            population[name] = record["population"]
+    return coordinates
 
-    response = make_request_with_retry(url)
 
-    if response.status_code == 200:
-        data = response.json()
-        # print("Log: request for {city} on {date_str} successful. Processing data...")
+async def get_weather_data(client, limiter, city, lat, lon, date_str):
+    """Get weather data for a city on a specific date in the format YYYY-MM-DD"""
+    key = f"{lat:.4f}|{lon:.4f}|{date_str}"
+    if key in CACHE:
+        data = CACHE[key]
     else:
-        print(f"*** Warning: Request failed after {RETRY_TIMES} attempts. Final status code: {response.status_code} ***")
-        data = response.json()
+        if key not in _IN_FLIGHT:
+            task = asyncio.ensure_future(_request_day_summary(client, limiter, key, lat, lon, date_str))
+            _IN_FLIGHT[key] = task
+            task.add_done_callback(lambda _: _IN_FLIGHT.pop(key, None))
+        data = await _IN_FLIGHT[key]
 
-    # Check if response is empty
+    # Failed and empty responses were already reported by _request_day_summary
     if data:
-        flattened_data = flatten(data)
-        # add columns for easier processing in Excel
-        flattened_data["city_name"] = city
-        return flattened_data
-    else:  # data is empty
-        print(f"*** Warning: No geo-coding data found for {city} on {date_str} ***")
-        return None
+        return _flatten_day(data, city)
+    return None
 
 
-def make_request_with_retry(url):
-    for attempt in range(RETRY_TIMES):
-        # check if Proxy is required
-        if USE_PROXY == True:
-            response = requests.get(url, proxies=PROXY_ADDRESS)
-        else:
-            response = requests.get(url)
-
-        if response.status_code == 200:
-            return response
-        else:
-            print(f"Warning: Attempt {attempt + 1} failed. Status code: {response.status_code}")
-            if attempt < RETRY_TIMES - 1:  # Don't sleep after the last attempt
-                sleep(RETRY_DELAY)
-    
-    print(f"Warning: All {RETRY_TIMES} attempts failed.")
-    return response  # Return the last response even if it's not 200
-
-def update_csv_with_new_column(file_path, new_fieldnames):
-    """In case a key is not found in the header, update the CSV file with a new column"""
-    temp_file = file_path + ".temp"
-    with open(file_path, "r", newline="", encoding="utf-8-sig") as csvfile, open(
-        temp_file, "w", newline="", encoding="utf-8-sig"
-    ) as tempfile:
-        reader = csv.DictReader(csvfile)
-        writer = csv.DictWriter(tempfile, fieldnames=new_fieldnames)
-        writer.writeheader()
-        for row in reader:
-            for field in new_fieldnames:
-                if field not in row:
-                    row[field] = "NA"
-            writer.writerow(row)
-    os.replace(temp_file, file_path)
+async def _request_day_summary(client, limiter, key, lat, lon, date_str):
+    """Request the day summary from the API and cache it on success."""
+    url = f"https://api.openweathermap.org/data/3.0/onecall/day_summary?lat={lat}&lon={lon}&date={date_str}&units=metric&appid={API_KEY}"
+
+    try:
+        data = await make_request_with_retry(client, limiter, url)
+    except httpx.HTTPError as e:
+        print(f"*** Warning: Request for {date_str} at {lat}, {lon} failed: {_describe_error(e)} ***")
+        return None
+
+    # Check if response is empty
+    if data:
+        CACHE[key] = data
+    else:
+        print(f"*** Warning: No weather data found for {date_str} at {lat}, {lon} ***")
+    return data
+
+
+def _flatten_day(data, city):
+    """Flatten a day_summary response into a single row.
+
+    The response has a fixed shape, so the fields are picked directly instead of walking the JSON.
+    Column names are the same as flatten_json would give, fields missing from the response are "NA"."""
+    cloud_cover = data.get("cloud_cover", {})
+    humidity = data.get("humidity", {})
+    precipitation = data.get("precipitation", {})
+    temperature = data.get("temperature", {})
+    pressure = data.get("pressure", {})
+    wind_max = data.get("wind", {}).get("max", {})
+    return {
+        "lat": data.get("lat", "NA"),
+        "lon": data.get("lon", "NA"),
+        "tz": data.get("tz", "NA"),
+        "date": data.get("date", "NA"),
+        "units": data.get("units", "NA"),
+        "cloud_cover_afternoon": cloud_cover.get("afternoon", "NA"),
+        "humidity_afternoon": humidity.get("afternoon", "NA"),
+        "precipitation_total": precipitation.get("total", "NA"),
+        "temperature_min": temperature.get("min", "NA"),
+        "temperature_max": temperature.get("max", "NA"),
+        "temperature_afternoon": temperature.get("afternoon", "NA"),
+        "temperature_night": temperature.get("night", "NA"),
+        "temperature_evening": temperature.get("evening", "NA"),
+        "temperature_morning": temperature.get("morning", "NA"),
+        "pressure_afternoon": pressure.get("afternoon", "NA"),
+        "wind_max_speed": wind_max.get("speed", "NA"),
+        "wind_max_direction": wind_max.get("direction", "NA"),
+        # add columns for easier processing in Excel
+        "city_name": city,
+    }
+
+
+def _is_retryable(exception):
+    """Network errors, rate limiting (429) and server errors (5xx) are worth retrying."""
+    if isinstance(exception, httpx.HTTPStatusError):
+        status = exception.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exception, httpx.TransportError)
+
+
+def _describe_error(exception):
+    """Describe a request error without its message, which contains the URL and thus the API key."""
+    if isinstance(exception, httpx.HTTPStatusError):
+        return f"status code {exception.response.status_code}"
+    return type(exception).__name__
+
+
+def _log_retry(retry_state):
+    print(f"Warning: Attempt {retry_state.attempt_number} failed: {_describe_error(retry_state.outcome.exception())}")
+
+
+@retry(
+    stop=stop_after_attempt(RETRY_TIMES),
+    wait=wait_exponential(multiplier=1, min=1, max=RETRY_MAX_DELAY),
+    retry=retry_if_exception(_is_retryable),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+async def make_request_with_retry(client, limiter, url):
+    """Request the url and return the JSON body.
+
+    Transient failures are retried with exponential backoff; if all attempts fail, or the error is
+    not worth retrying (e.g. 401), the httpx.HTTPError is raised.
+    Every attempt takes a slot from the limiter, so retries also count towards the rate limit."""
+    async with limiter:
+        response = await client.get(url)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+async def fetch_to_queue(queue, client, limiter, jobs):
+    """Get weather data for each (city, lat, lon, date_str) taken from jobs and hand it over to the csv writer.
+
+    jobs is an iterator shared by all workers, so every job is only taken once."""
+    for city, lat, lon, date_str in jobs:
+        data = await get_weather_data(client, limiter, city, lat, lon, date_str)
+        if data:
+            await queue.put(data)
+
+
+async def write_rows(queue, csvfile):
+    """Write rows from the queue to the open CSV file as they arrive, until None is received.
+
+    The header is taken from the first row. Returns the number of rows written."""
+    num_rows = 0
+    writer = None
+    while (row := await queue.get()) is not None:
+        if writer is None:  # New csv, no header yet
+            writer = csv.DictWriter(csvfile, fieldnames=list(row.keys()), restval="NA")
+            writer.writeheader()
+        writer.writerow(row)
+        csvfile.flush()  # so that the row is on disk while other requests are still running
+        num_rows += 1
+        print(f"Data for {row['city_name']} on {row['date']} appended to {csvfile.name}.")
+    return num_rows
+
+
+async def collect_weather_data(cities, date_strs, file_path):
+    """Geo-code every city, then fetch weather data for every city and date concurrently.
+
+    Rows are written to the CSV file while other requests are still waiting for the API, in the
+    order they complete. Returns the number of rows written."""
+    # Only blocks once the API rate limit is reached, instead of sleeping after every request
+    limiter = AsyncLimiter(RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD)
+    # Together with the fixed number of workers, this caps the fetched rows waiting to be written
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    # check if Proxy is required
+    proxy = PROXY_ADDRESS["https"] if USE_PROXY else None
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS)
+    # Opened before any request is made, so that an unwritable output fails before using the API quota
+    with open(file_path, "w", newline="", encoding="utf-8-sig") as csvfile:
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT, proxy=proxy) as client:
+            coords = await asyncio.gather(*[get_city_coordinates(client, limiter, city) for city in cities])
+            city_coords = dict(zip(cities, coords))
+
+            # If the writer fails, the task group cancels the fetchers instead of leaving them
+            # blocked on the full queue
+            async with asyncio.TaskGroup() as group:
+                writer = group.create_task(write_rows(queue, csvfile))
+                jobs = (
+                    (city, lat, lon, date_str)
+                    for date_str in date_strs
+                    for city, (lat, lon) in city_coords.items()
+                    if lat is not None and lon is not None
+                )
+                fetchers = [
+                    group.create_task(fetch_to_queue(queue, client, limiter, jobs)) for _ in range(FETCH_WORKERS)
+                ]
+                await asyncio.gather(*fetchers)
+                await queue.put(None)  # all data fetched, stop the writer
+            return writer.result()
 
 
 def validate_date_range(start_date, end_date):
@@ -142,13 +297,6 @@ def validate_date_range(start_date, end_date):
     return True
 
 
-def write_csv_header(file_path, fieldnames):
-    """Write the CSV header"""
-    with open(file_path, "w", newline="", encoding="utf-8-sig") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-
 def main():
     # Check if output exists
     if not confirm_overwrite(OUTPUT_FILE):
@@ -159,47 +307,12 @@ def main():
     if not validate_date_range(START_DATE, END_DATE):
         return
 
-    city_coords = {city: get_city_coordinates(city) for city in CITIES}
-    date_range = pd.date_range(start=START_DATE, end=END_DATE, freq="D")
-
-    fieldnames = None  # header of the csv
-    for date in date_range:
-        for city, (lat, lon) in city_coords.items():
-            if lat is not None and lon is not None:
-                date_str = date.strftime("%Y-%m-%d")
-                data = get_weather_data(city, lat, lon, date_str)
-                if data:
-
-                    if fieldnames is None:  # New csv, no header yet
-                        fieldnames = list(data.keys())
-                        write_csv_header(OUTPUT_FILE, fieldnames)
-
-                    elif set(data.keys()) != set(
-                        fieldnames
-                    ):  # Data does not match the header
-                        new_fields = set(data.keys()) - set(fieldnames)
-                        missing_fields = set(fieldnames) - set(data.keys())
-
-                        if new_fields:  # A new field was found, need to update header
-                            fieldnames.extend(new_fields)
-                            update_csv_with_new_column(OUTPUT_FILE, fieldnames)
-                            print(f"New column(s) added: {', '.join(new_fields)}")
-
-                        # if missing_fields:  # Missing values, no need to worry
-                        #     print(
-                        #         f"Debug: some columns are missing: {', '.join(missing_fields)}. No need to worry."
-                        #     )
-
-                    # Ensure all fieldnames are present in data
-                    for field in fieldnames:
-                        if field not in data:
-                            data[field] = "NA"
-
-                    # Write the new row to csv
-                    append_to_csv(OUTPUT_FILE, data, fieldnames)
-                    print(f"Data for {city} on {date_str} appended to {OUTPUT_FILE}.")
-
-                sleep(1)  # To avoid hitting API rate limits
+    date_strs = pd.date_range(start=START_DATE, end=END_DATE, freq="D").strftime("%Y-%m-%d").tolist()
+
+    num_rows = asyncio.run(collect_weather_data(CITIES, date_strs, OUTPUT_FILE))
+    if not num_rows:
+        print("*** Error: no weather data was collected. ***")
+        return
 
     print(f"Data collection complete. All data saved to {OUTPUT_FILE}.")
 
@@ -3,79 +3,39 @@ import glob
 import os
 from collections import defaultdict
 import re
-import pandas as pd
+import datetime
 
 OUTPUT_FILE = ".\\data\\weather_data_aggregated.csv"
 
-
-def check_duplicates(file_path):
-    """Check for duplicate rows in a CSV file. If so, delete these rows and save to a new file."""
-    df = pd.read_csv(file_path)
-
-    # Check for duplicate rows
-    duplicates = df.duplicated()
-
-    if duplicates.any():
-        num_duplicates = duplicates.sum()
-        print(f"*** Warning: duplicates found.\nNumber of duplicate rows: {num_duplicates} ***")
-        df_no_duplicates = df.drop_duplicates()
-        new_file_path = file_path + ".dedup.csv"
-        df_no_duplicates.to_csv(new_file_path, index=False)
-
-        print("Duplicates removed and saved to a new file: ")
-        print(new_file_path)
-
-    else:
-        print("No duplicate rows found.")
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
 
 def get_all_fieldnames(csv_files):
-    """Get all unique fieldnames from all CSV files"""
+    """Get all unique fieldnames from all CSV files. Only the headers are read."""
     all_fieldnames = set()
     for file in csv_files:
         with open(file, "r", newline="", encoding="utf-8-sig") as csvfile:
             reader = csv.DictReader(csvfile)
             all_fieldnames.update(reader.fieldnames)
-    return sorted(list(all_fieldnames))
+    return sorted(all_fieldnames)
 
 
 def is_valid_date(date_str):
-    """Check if the date string is in the format YYYY-MM-DD"""
-    return bool(re.match(r"^\d{4}-\d{2}-\d{2}$", date_str))
-
-
-def process_and_check_dates(input_file, output_file):
-    """Check if all dates are in the format of YYYY-MM-DD"""
-    incorrect_format_found = False
-    with open(input_file, "r", newline="", encoding="utf-8-sig") as infile, open(
-        output_file, "w", newline="", encoding="utf-8-sig"
-    ) as outfile:
-        reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for row in reader:
-            date = row["date"]
-            if date:  # Only process non-empty date fields
-                if not is_valid_date(date):
-                    incorrect_format_found = True
-            writer.writerow(row)
-
-    if incorrect_format_found:
-        print("*** Warning: Incorrect date format found. Manual checking is required. ***")
-
-    return output_file
+    """Check if the date string is in the format YYYY-MM-DD and is an actual date"""
+    if not _DATE_RE.match(date_str):
+        return False
+    try:
+        datetime.date.fromisoformat(date_str)
+    except ValueError:
+        return False
+    return True
 
 
-def merge_csv_files(output_file):
-    # Get all CSV files in the data folder
-    csv_files = glob.glob(".\\data\\weather_data_*.csv")
-
-    if not csv_files:
-        print("Error: No CSV files found with the pattern 'weather_data_*.csv'")
-        return
+def merge_all(csv_files, output_file):
+    """Merge the CSV files into output_file in a single pass.
 
+    Each input file is read once and the output is written once. Duplicate rows are dropped
+    and the date format is checked while the rows are streamed."""
     # Get all unique fieldnames
     all_fieldnames = get_all_fieldnames(csv_files)
 
@@ -84,11 +44,14 @@ def merge_csv_files(output_file):
         print("Error: 'date' and 'city_name' columns are required in all CSV files")
         return
 
-    # Write the merged data to a temporary file
-    temp_output_file = output_file + ".temp"
-    with open(temp_output_file, "w", newline="", encoding="utf-8-sig") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=all_fieldnames)
-        writer.writeheader()
+    # Duplicates are detected by the hash of the row values
+    seen_hashes = set()
+    num_duplicates = 0
+    invalid_dates = set()
+    with open(output_file, "w", newline="", encoding="utf-8-sig") as outfile:
+        # Values are already in header order, so a plain writer is enough
+        writer = csv.writer(outfile)
+        writer.writerow(all_fieldnames)
 
         for file in csv_files:
             print(f"Processing {file}...")
@@ -96,24 +59,44 @@ def merge_csv_files(output_file):
                 reader = csv.DictReader(infile)
                 for row in reader:
                     # Fill missing fields with "NA"
-                    for field in all_fieldnames:
-                        if field not in row:
-                            row[field] = "NA"
-                    writer.writerow(row)
+                    values = tuple(row.get(field, "NA") for field in all_fieldnames)
+                    key = hash(values)
+                    if key in seen_hashes:
+                        num_duplicates += 1
+                        continue
+                    seen_hashes.add(key)
+
+                    date = row.get("date", "NA")
+                    if date and not is_valid_date(date):  # Only check non-empty date fields
+                        invalid_dates.add(date)
+
+                    writer.writerow(values)
 
     print(f"Total number of columns: {len(all_fieldnames)}")
     print(f"Columns: {', '.join(all_fieldnames)}")
 
-    # Check for duplicates
-    check_duplicates(temp_output_file)
+    if num_duplicates:
+        print(f"*** Warning: duplicates found.\nNumber of duplicate rows: {num_duplicates} ***")
+        print("Duplicates removed.")
+    else:
+        print("No duplicate rows found.")
+
+    if invalid_dates:
+        print("*** Warning: Incorrect date format found. Manual checking is required. ***")
+        print(f"Invalid dates: {', '.join(sorted(invalid_dates))}")
+
+    print(f"Final output file with processed dates: {output_file}")
+
 
-    # Process and check dates
-    final_output_file = process_and_check_dates(temp_output_file, output_file)
+def merge_csv_files(output_file):
+    # Get all CSV files in the data folder
+    csv_files = glob.glob(".\\data\\weather_data_*.csv")
 
-    # Remove the temporary file
-    os.remove(temp_output_file)
+    if not csv_files:
+        print("Error: No CSV files found with the pattern 'weather_data_*.csv'")
+        return
 
-    print(f"Final output file with processed dates: {final_output_file}")
+    merge_all(csv_files, output_file)
 
 
 if __name__ == "__main__":